@@ -1,17 +1,20 @@
 import json
+import math
 import os
 import signal
 import threading
-from datetime import datetime
+import time
 from typing import Generator
 
-from flask import Flask, Response, jsonify, render_template, request, send_from_directory
+from flask import Flask, Response, jsonify, render_template, request, send_file, send_from_directory
 
-from .camera_manager import CameraManager
+from .camera_manager import CameraManager, timestamp
 
 
 APP_PORT = int(os.environ.get("PORT", "8000"))
+APP_THREADS = int(os.environ.get("THREADS", "16"))
 CAPTURES_DIR = os.path.join(os.path.dirname(__file__), "captures")
+PRESETS_PATH = os.path.join(os.path.dirname(__file__), "presets.json")
 
 app = Flask(__name__)
 manager = CameraManager()
@@ -27,33 +30,61 @@ def api_cameras():
     return jsonify({"cameras": manager.list_cameras()})
 
 
-def mjpeg_generator(cam_id: str) -> Generator[bytes, None, None]:
-    boundary = b"--frame"
+# Multipart part header; the CRLF that ends the previous part leads the
+# boundary so each frame needs just this small header plus the JPEG itself.
+_MJPEG_PART_HEADER = b"\r\n--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n"
+
+
+def mjpeg_generator(cam_id: str, fps: float = 0.0) -> Generator[bytes, None, None]:
     ctrl = manager.get(cam_id)
     output = ctrl.output
-    while True:
-        with output.condition:
-            output.condition.wait()
-            frame = output.frame
-        if frame is None:
-            continue
-        yield (
-            boundary
-            + b"\r\nContent-Type: image/jpeg\r\nContent-Length: "
-            + str(len(frame)).encode()
-            + b"\r\n\r\n"
-            + frame
-            + b"\r\n"
-        )
+    # fps <= 0 forwards every encoded frame
+    min_interval = 1.0 / fps if fps > 0 else 0.0
+    last_sent = 0.0
+    last_seq = output.seq
+    sent = 0
+    dropped = 0
+    try:
+        while True:
+            # A frame published while we were yielding is picked up immediately
+            frame, seq = output.wait_frame(last_seq)
+            if seq == last_seq:
+                continue
+            last_seq = seq
+            if frame is None:
+                continue
+            now = time.monotonic()
+            if now - last_sent < min_interval:
+                dropped += 1
+                continue
+            last_sent = now
+            # Header and frame are separate chunks, so the JPEG is never
+            # concatenated with its header here; waitress still copies each
+            # chunk into its per-connection output buffer.
+            yield _MJPEG_PART_HEADER % len(frame)
+            yield frame
+            sent += 1
+    finally:
+        app.logger.info("stream %s closed: sent=%d dropped_frames=%d", cam_id, sent, dropped)
 
 
 @app.route("/stream/<cam_id>.mjpg")
 def stream(cam_id: str):
-    if cam_id not in {c["id"] for c in manager.list_cameras()}:
+    if not manager.has(cam_id):
         return "Camera not found", 404
+    # Omitted means unthrottled; anything given must be a positive number
+    fps = 0.0
+    raw_fps = request.args.get("fps")
+    if raw_fps is not None:
+        try:
+            fps = float(raw_fps)
+        except ValueError:
+            fps = float("nan")
+        if not math.isfinite(fps) or fps <= 0:
+            return "fps must be a positive number", 400
     headers = {"Age": "0", "Cache-Control": "no-cache, private", "Pragma": "no-cache"}
     return Response(
-        mjpeg_generator(cam_id),
+        mjpeg_generator(cam_id, fps=fps),
         mimetype="multipart/x-mixed-replace; boundary=frame",
         headers=headers,
         direct_passthrough=True,
@@ -62,7 +93,7 @@ def stream(cam_id: str):
 
 @app.route("/api/<cam_id>/controls", methods=["GET", "POST"])
 def controls_endpoint(cam_id: str):
-    if cam_id not in {c["id"] for c in manager.list_cameras()}:
+    if not manager.has(cam_id):
         return "Camera not found", 404
     ctrl = manager.get(cam_id)
     if request.method == "POST":
@@ -70,7 +101,10 @@ def controls_endpoint(cam_id: str):
             data = request.get_json(force=True, silent=True) or {}
         except Exception:
             data = {}
-        ctrl.set_controls(data)
+        try:
+            ctrl.set_controls(data)
+        except (TypeError, ValueError) as e:
+            return jsonify({"status": "error", "error": str(e)}), 400
         return jsonify({"status": "ok"})
     else:
         md = ctrl.get_metadata()
@@ -79,7 +113,7 @@ def controls_endpoint(cam_id: str):
 
 @app.route("/api/<cam_id>/af_trigger", methods=["POST"])
 def af_trigger(cam_id: str):
-    if cam_id not in {c["id"] for c in manager.list_cameras()}:
+    if not manager.has(cam_id):
         return "Camera not found", 404
     ctrl = manager.get(cam_id)
     data = request.get_json(force=True, silent=True) or {}
@@ -90,7 +124,7 @@ def af_trigger(cam_id: str):
 
 @app.route("/api/<cam_id>/capture", methods=["GET", "POST"])
 def capture(cam_id: str):
-    if cam_id not in {c["id"] for c in manager.list_cameras()}:
+    if not manager.has(cam_id):
         return "Camera not found", 404
     ctrl = manager.get(cam_id)
     if request.method == "GET":
@@ -102,7 +136,7 @@ def capture(cam_id: str):
         filename = None
         if save:
             os.makedirs(CAPTURES_DIR, exist_ok=True)
-            filename = f"{ctrl.label}_" + datetime.now().strftime("%Y%m%d_%H%M%S_%f") + ".jpg"
+            filename = f"{ctrl.label}_{timestamp()}.jpg"
             path = os.path.join(CAPTURES_DIR, filename)
             try:
                 with open(path, 'wb') as f:
@@ -135,16 +169,25 @@ def captures(filename: str):
 
 @app.route("/api/presets", methods=["GET", "POST"])
 def presets():
-    presets_path = os.path.join(os.path.dirname(__file__), "presets.json")
     if request.method == "GET":
-        if os.path.exists(presets_path):
-            with open(presets_path, "r", encoding="utf-8") as f:
-                return jsonify(json.load(f))
+        if os.path.exists(PRESETS_PATH):
+            # Serve the file as-is; ETag/Last-Modified let browsers revalidate with a 304
+            return send_file(PRESETS_PATH, mimetype="application/json", conditional=True, etag=True)
         return jsonify({"presets": {}})
     else:
         data = request.get_json(force=True, silent=True) or {}
-        with open(presets_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2)
+        # Serialize once and hand it to the kernel in a single write; write
+        # beside the target then swap in, so readers never see a partial file
+        buf = json.dumps(data, indent=2).encode("utf-8")
+        tmp_path = PRESETS_PATH + ".tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            view = memoryview(buf)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, PRESETS_PATH)
         return jsonify({"status": "ok"})
 
 
@@ -160,7 +203,20 @@ signal.signal(signal.SIGTERM, _shutdown)
 
 
 def run():  # pragma: no cover
-    app.run(host="0.0.0.0", port=APP_PORT, threaded=True)
+    try:
+        from waitress import serve
+    except ImportError:
+        # Fall back to Flask's dev server when waitress isn't installed
+        app.run(host="0.0.0.0", port=APP_PORT, threaded=True)
+        return
+    # Bounded worker pool; each open MJPEG stream holds one thread
+    # Small per-connection output buffers: once a slow viewer has ~256 KiB
+    # queued the stream thread blocks (and then skips to the newest frame)
+    # instead of waitress buffering seconds of stale frames or spilling
+    # them to a tempfile on the SD card
+    serve(app, host="0.0.0.0", port=APP_PORT, threads=APP_THREADS,
+          channel_timeout=120, asyncore_use_poll=True,
+          outbuf_high_watermark=256 * 1024, outbuf_overflow=512 * 1024)
 
 
 if __name__ == "__main__":  # pragma: no cover
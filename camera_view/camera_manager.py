@@ -2,10 +2,9 @@ import io
 import os
 import threading
 import time
-from datetime import datetime
 
 from picamera2 import Picamera2
-from picamera2.encoders import MJPEGEncoder
+from picamera2.encoders import MJPEGEncoder, Quality
 from picamera2.outputs import FileOutput
 
 try:
@@ -14,22 +13,78 @@ try:
 except Exception:  # pragma: no cover
     controls = None  # Fallback to raw values if enums unavailable
 
+# Friendly name -> enum lookups, built once rather than per control request
+if controls is not None:
+    _AF_MODE_MAP = {
+        "manual": controls.AfModeEnum.Manual,
+        "auto": controls.AfModeEnum.Auto,
+        "continuous": controls.AfModeEnum.Continuous,
+    }
+    _AF_TRIGGER_MAP = {
+        "start": controls.AfTriggerEnum.Start,
+        "cancel": controls.AfTriggerEnum.Cancel,
+    }
+else:  # pragma: no cover
+    _AF_MODE_MAP = {}
+    _AF_TRIGGER_MAP = {}
+
+
+def timestamp() -> str:
+    """Local time as ``YYYYmmdd_HHMMSS_ffffff`` (``strftime("%Y%m%d_%H%M%S_%f")``).
+
+    Built from integer fields; strftime is noticeably slower in rapid capture loops.
+    """
+    ns = time.time_ns()
+    us = (ns // 1000) % 1_000_000
+    t = time.localtime(ns // 1_000_000_000)
+    return (
+        f"{t.tm_year:04d}{t.tm_mon:02d}{t.tm_mday:02d}_"
+        f"{t.tm_hour:02d}{t.tm_min:02d}{t.tm_sec:02d}_{us:06d}"
+    )
+
 
 class StreamingOutput(io.BufferedIOBase):
     def __init__(self):
-        self.frame = None  # type: bytes | None
-        self.condition = threading.Condition()
+        # Latest (frame, seq) pair; replaced with a single attribute assignment
+        # so readers always see a matching frame and sequence number.
+        self.latest = (None, 0)  # type: tuple[bytes | None, int]
+        # Set once when the next frame lands, then replaced by a fresh event
+        self.event = threading.Event()
+
+    @property
+    def frame(self) -> bytes | None:
+        return self.latest[0]
+
+    @property
+    def seq(self) -> int:
+        return self.latest[1]
 
     def writable(self) -> bool:  # type: ignore[override]
         return True
 
     def write(self, buf: bytes) -> int:  # type: ignore[override]
-        # For MJPEGEncoder, each call to write is a complete JPEG frame
-        with self.condition:
-            self.frame = bytes(buf)
-            self.condition.notify_all()
+        # For MJPEGEncoder, each call to write is a complete JPEG frame.
+        # FileOutput already hands us immutable bytes; only copy views.
+        frame = buf if isinstance(buf, bytes) else bytes(buf)
+        self.latest = (frame, self.latest[1] + 1)
+        # Swap in a fresh event before waking readers so late arrivals
+        # block until the frame after this one.
+        event, self.event = self.event, threading.Event()
+        event.set()
         return len(buf)
 
+    def wait_frame(self, last_seq: int, timeout: float | None = None) -> tuple[bytes | None, int]:
+        """Block until a frame newer than ``last_seq`` is published.
+
+        Returns the latest ``(frame, seq)``; ``seq == last_seq`` on timeout.
+        """
+        event = self.event
+        latest = self.latest
+        if latest[1] != last_seq:
+            return latest
+        event.wait(timeout)
+        return self.latest
+
 
 class CameraController:
     def __init__(self, index: int, label: str | None = None,
@@ -52,11 +107,55 @@ class CameraController:
         # Streaming output for MJPEG
         self.output = StreamingOutput()
         self.encoder = MJPEGEncoder()
+        # Encoder tuning; an explicit bitrate takes precedence over quality
+        self.encoder_bitrate = None  # type: int | None
+        self.encoder_quality = Quality.MEDIUM
 
         # Start camera and MJPEG recording
         self.picam2.start()
         # Send encoded frames to our in-memory output
-        self.picam2.start_recording(self.encoder, FileOutput(self.output))
+        self._start_recording()
+
+    def _start_recording(self):
+        self.picam2.start_recording(
+            self.encoder, FileOutput(self.output), quality=self._recording_quality()
+        )
+
+    def set_encoder(self, bitrate=None, quality=None):
+        """Restart the MJPEG encoder with a new bitrate (bits/s) or quality.
+
+        Lower settings cut both encode work and bytes per streamed frame.
+        A bitrate of 0 clears it so the quality preset applies again.
+        """
+        with self.lock:
+            new_bitrate = self.encoder_bitrate
+            new_quality = self.encoder_quality
+            if bitrate is not None:
+                new_bitrate = int(bitrate)
+                if new_bitrate < 0:
+                    raise ValueError(f"bitrate must be >= 0, got {bitrate!r}")
+                new_bitrate = new_bitrate or None
+            if quality is not None:
+                new_quality = self._encoder_quality_value(quality)
+            if new_bitrate == self.encoder_bitrate and new_quality == self.encoder_quality:
+                # Unchanged settings; don't tear down a running encoder
+                return
+            self.encoder_bitrate = new_bitrate
+            self.encoder_quality = new_quality
+            try:
+                self.picam2.stop_encoder()
+            except Exception:
+                pass
+            self.encoder = MJPEGEncoder(bitrate=self.encoder_bitrate)
+            # Only the encoder restarts; the camera keeps running
+            self.picam2.start_encoder(
+                self.encoder, FileOutput(self.output), quality=self._recording_quality()
+            )
+
+    def _recording_quality(self):
+        # Picamera2 derives the bitrate from quality whenever one is passed,
+        # so leave it out when an explicit bitrate is set
+        return None if self.encoder_bitrate else self.encoder_quality
 
     def get_metadata(self) -> dict:
         # Latest metadata snapshot (exposure, gains, etc.)
@@ -69,11 +168,15 @@ class CameraController:
     def set_controls(self, ctrl: dict):
         # Translate some friendly keys if present
         m = {}
+        encoder = {}
         for k, v in ctrl.items():
             if v is None:
                 continue
             # Map common aliases
-            if k == "exposure_time":
+            if k in ("encoder_bitrate", "encoder_quality"):
+                # Preview encoder tuning rather than a libcamera control
+                encoder[k[len("encoder_"):]] = v
+            elif k == "exposure_time":
                 m["ExposureTime"] = int(v)
             elif k == "analogue_gain" or k == "analog_gain":
                 m["AnalogueGain"] = float(v)
@@ -101,39 +204,32 @@ class CameraController:
                 # Pass through raw control name
                 m[k] = v
 
+        if encoder:
+            self.set_encoder(**encoder)
         if not m:
             return
         with self.lock:
             self.picam2.set_controls(m)
 
-    def _af_mode_value(self, v):
-        if controls is None:
-            return v
+    def _encoder_quality_value(self, v):
+        # Accept preset names such as "low" or "very_high", or the enum's int
+        # value; anything else raises ValueError
         if isinstance(v, str):
-            name = v.strip().lower()
-            mapping = {
-                "manual": controls.AfModeEnum.Manual,
-                "auto": controls.AfModeEnum.Auto,
-                "continuous": controls.AfModeEnum.Continuous,
-            }
-            return mapping.get(name, v)
-        return v
+            name = v.strip().upper().replace("-", "_").replace(" ", "_")
+            if name not in Quality.__members__:
+                raise ValueError(f"unknown encoder quality {v!r}")
+            return Quality[name]
+        return Quality(int(v))
+
+    def _af_mode_value(self, v):
+        return _AF_MODE_MAP.get(v.strip().lower(), v) if isinstance(v, str) else v
 
     def _af_trigger_value(self, v):
-        if controls is None:
-            return v
-        if isinstance(v, str):
-            name = v.strip().lower()
-            mapping = {
-                "start": controls.AfTriggerEnum.Start,
-                "cancel": controls.AfTriggerEnum.Cancel,
-            }
-            return mapping.get(name, v)
-        return v
+        return _AF_TRIGGER_MAP.get(v.strip().lower(), v) if isinstance(v, str) else v
 
     def capture_still(self, dir_path: str) -> str:
         os.makedirs(dir_path, exist_ok=True)
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        ts = timestamp()
         filename = f"{self.label}_{ts}.jpg"
         path = os.path.join(dir_path, filename)
         with self.lock:
@@ -150,7 +246,7 @@ class CameraController:
 
             # Resume MJPEG recording
             try:
-                self.picam2.start_recording(self.encoder, FileOutput(self.output))
+                self._start_recording()
             except Exception:
                 pass
         return path
@@ -194,7 +290,7 @@ class CameraController:
                 # Switch back to preview mode and resume MJPEG
                 self.picam2.switch_mode(self.preview_config)
                 try:
-                    self.picam2.start_recording(self.encoder, FileOutput(self.output))
+                    self._start_recording()
                 except Exception:
                     pass
             return data or b''
@@ -219,16 +315,18 @@ class CameraManager:
             label = cam.get("Model") or cam.get("Id") or f"cam{idx}"
             controller = CameraController(index=idx, label=label)
             self.controllers[str(idx)] = controller
+        # Cameras are enumerated once; cache their ids and listing for requests
+        self._ids = frozenset(self.controllers)
+        self._cams_cached = [
+            {"id": cam_id, "label": ctrl.label, "index": ctrl.index}
+            for cam_id, ctrl in self.controllers.items()
+        ]
+
+    def has(self, cam_id: str) -> bool:
+        return cam_id in self._ids
 
     def list_cameras(self):
-        cams = []
-        for cam_id, ctrl in self.controllers.items():
-            cams.append({
-                "id": cam_id,
-                "label": ctrl.label,
-                "index": ctrl.index,
-            })
-        return cams
+        return self._cams_cached
 
     def get(self, cam_id: str) -> CameraController:
         return self.controllers[cam_id]
@@ -2,16 +2,17 @@ import base64
 import io
 import os
 import json
+import queue
+import re
 import signal
 import threading
 import time
-from datetime import datetime
 from typing import Any, Dict, Optional
 
-from flask import Flask, Response, jsonify, request, send_from_directory
+from flask import Flask, Response, g, jsonify, request, send_from_directory
 
 from .serial_io import SerialManager
-from .camera import CameraController, mjpeg_stream, transform_jpeg
+from .camera import CameraController, mjpeg_stream, timestamp, transform_jpeg
 
 
 # Defaults tailored to your setup
@@ -36,23 +37,85 @@ class State:
     def __init__(self):
         self.serial: Optional[SerialManager] = None
         self.serial_lock = threading.Lock()
-        self.camera = CameraController(index=0, label="rpi_cam0")
+        # Opened on first use so motion-only runs and /health don't hold the camera
+        self.camera: Optional[CameraController] = None
+        self.cam_lock = threading.Lock()
         self.settle_sec: float = SETTLE_DEFAULT
         self.feed_xy: int = FEED_XY_DEFAULT
         self.feed_z: int = FEED_Z_DEFAULT
         self.anchor = {"x": ANCHOR_X, "y": ANCHOR_Y, "z": ANCHOR_Z}
+
+
+STATE = State()
+
+
+# Session directories already created this run; skips a makedirs/stat per capture
+_CREATED_DIRS: set[str] = set()
+
+
+def _ensure_dir(path: str):
+    if path not in _CREATED_DIRS:
+        os.makedirs(path, exist_ok=True)
+        _CREATED_DIRS.add(path)
+
+
+# Captures are written by a single background thread so request handlers
+# don't block on SD-card I/O; bounded so a stalled card pushes back.
+_WRITE_QUEUE: "queue.Queue[tuple[str, bytes]]" = queue.Queue(maxsize=64)
+
+
+def _write_file(path: str, data: bytes):
+    part = path + ".part"
+    try:
+        f = open(part, "wb")
+    except FileNotFoundError:
+        # Directory removed since it was cached as created
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f = open(part, "wb")
+    with f:
+        f.write(data)
+    # Only complete files ever appear under the final name
+    os.replace(part, path)
+
+
+def _writer_loop():
+    while True:
+        path, data = _WRITE_QUEUE.get()
+        try:
+            _write_file(path, data)
+        except Exception:
+            app.logger.exception("Failed to write capture %s", path)
+        finally:
+            _WRITE_QUEUE.task_done()
+
+
+def _queue_write(path: str, data: bytes):
+    try:
+        _WRITE_QUEUE.put_nowait((path, data))
+    except queue.Full:
+        # Writer is backed up; write inline rather than drop the capture
+        _write_file(path, data)
+
+
+threading.Thread(target=_writer_loop, name="capture-writer", daemon=True).start()
+
+
+def _ensure_camera() -> CameraController:
+    with STATE.cam_lock:
+        if STATE.camera is not None:
+            return STATE.camera
+        cam = CameraController(index=0, label="rpi_cam0")
         # Apply persisted camera defaults if present
         try:
             if os.path.exists(CAM_DEFAULTS_PATH):
                 with open(CAM_DEFAULTS_PATH, "r", encoding="utf-8") as f:
                     defaults = json.load(f) or {}
                 if isinstance(defaults, dict) and defaults:
-                    self.camera.set_controls(defaults)
+                    cam.set_controls(defaults)
         except Exception:
             pass
-
-
-STATE = State()
+        STATE.camera = cam
+        return cam
 
 
 def _ensure_serial() -> SerialManager:
@@ -67,21 +130,38 @@ def _ensure_serial() -> SerialManager:
         return sm
 
 
+# Axis:value pairs in an M114 report, matched on the raw serial bytes
+_M114_RE = re.compile(rb"([A-Za-z]+):(-?\d+(?:\.\d+)?)")
+
+
 def _parse_m114(line_bytes: bytes) -> Dict[str, float]:
-    try:
-        text = line_bytes.decode("ascii", errors="ignore")
-    except Exception:
-        text = ""
     # Typical: "X:0.000 Y:0.000 Z:0.000 E:0.000 Count X:0 Y:0 Z:0"
-    vals: Dict[str, float] = {}
-    for part in text.replace("\n", " ").split():
-        if ":" in part:
-            k, v = part.split(":", 1)
-            try:
-                vals[k] = float(v)
-            except Exception:
-                pass
-    return {k.lower(): v for k, v in vals.items()}
+    # Anything after "Count" is stepper counts, not positions.
+    line_bytes = line_bytes.split(b"Count", 1)[0]
+    return {m.group(1).decode().lower(): float(m.group(2)) for m in _M114_RE.finditer(line_bytes)}
+
+
+@app.before_request
+def _parse_json_body():
+    # Parse a JSON body once per request. An empty body means "use defaults";
+    # a body that isn't declared (or doesn't parse) as JSON is rejected up
+    # front so the handler never runs with silently dropped parameters.
+    g.json_body = None
+    if request.method not in ("POST", "PUT", "PATCH") or not request.get_data(cache=True):
+        return None
+    if not request.is_json:
+        return jsonify({"ok": False, "error": "request body must be application/json"}), 415
+    g.json_body = request.get_json(silent=True)
+    if g.json_body is None:
+        return jsonify({"ok": False, "error": "invalid JSON body"}), 400
+    if not isinstance(g.json_body, dict):
+        g.json_body = None
+        return jsonify({"ok": False, "error": "JSON body must be an object"}), 400
+    return None
+
+
+def _json_body() -> Dict[str, Any]:
+    return g.get("json_body") or {}
 
 
 @app.get("/health")
@@ -89,7 +169,8 @@ def health():
     return jsonify({
         "status": "ok",
         "version": 1,
-        "serial_connected": bool(STATE.serial and STATE.serial.is_connected()),
+        "serial_connected": STATE.serial.connected if STATE.serial else False,
+        "camera_open": STATE.camera is not None,
         "feed_xy": STATE.feed_xy,
         "feed_z": STATE.feed_z,
         "settle_sec": STATE.settle_sec,
@@ -110,7 +191,7 @@ def printer_connect():
 
 @app.post("/printer/home")
 def printer_home():
-    axes = (request.json or {}).get("axes", "XYZ")
+    axes = _json_body().get("axes", "XYZ")
     axes = "".join(ch for ch in str(axes).upper() if ch in "XYZ") or "XYZ"
     sm = _ensure_serial()
     sm.send_commands([f"G28 {axes}", "G90"], wait_ok=True)
@@ -119,7 +200,7 @@ def printer_home():
 
 @app.post("/printer/set_center")
 def printer_set_center():
-    data = request.get_json(force=True, silent=True) or {}
+    data = _json_body()
     x = float(data.get("x", STATE.anchor["x"]))
     y = float(data.get("y", STATE.anchor["y"]))
     z = float(data.get("z", STATE.anchor["z"]))
@@ -131,7 +212,7 @@ def printer_set_center():
 
 @app.post("/printer/move")
 def printer_move():
-    data = request.get_json(force=True, silent=True) or {}
+    data = _json_body()
     x = data.get("x")
     y = data.get("y")
     z = data.get("z")
@@ -141,21 +222,19 @@ def printer_move():
     safe = bool(data.get("safe", False))
 
     sm = _ensure_serial()
-    cmds: list[str] = ["G90"]  # absolute moves
+    # Built as ASCII bytes so SerialManager writes them without re-encoding
+    cmds: list[bytes] = [b"G90"]  # absolute moves
 
     # Simple strategy: split XY vs Z so we can use different feedrates
     def add_xy():
-        parts = ["G0", f"F{feed_xy}"]
-        if x is not None:
-            parts.append(f"X{float(x):.4f}")
-        if y is not None:
-            parts.append(f"Y{float(y):.4f}")
-        if len(parts) > 2:
-            cmds.append(" ".join(parts))
+        xpart = b" X%.4f" % float(x) if x is not None else b""
+        ypart = b" Y%.4f" % float(y) if y is not None else b""
+        if xpart or ypart:
+            cmds.append(b"G0 F%d%s%s" % (feed_xy, xpart, ypart))
 
     def add_z():
         if z is not None:
-            cmds.append(f"G0 F{feed_z} Z{float(z):.4f}")
+            cmds.append(b"G0 F%d Z%.4f" % (feed_z, float(z)))
 
     if safe and z is not None and (x is not None or y is not None):
         # Raise first to target Z (or leave Z unchanged if target higher)
@@ -166,27 +245,27 @@ def printer_move():
         add_z()
 
     if wait:
-        cmds.append("M400")
-    sm.send_commands(cmds, wait_ok=True)
+        cmds.append(b"M400")
+    sm.send_batch(cmds)
     return jsonify({"ok": True})
 
 
 @app.get("/printer/position")
 def printer_position():
     sm = _ensure_serial()
-    # Request a position report and read until ok; capture the last line with coords
-    # Using a small hack: send M114 and immediately read one line from serial
-    # via private method by sending commands individually.
+    # M114 prints the position report before its 'ok'
     try:
-        sm.send_commands(["M114"], wait_ok=True)
+        lines = sm.query("M114")
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
-    # Position will have been printed before the ok; we cannot easily grab it
-    # without modifying SerialManager to expose reads. Return anchor and feeds.
-    # If needed, we can later extend SerialManager to read the line.
+    position: Dict[str, float] = {}
+    for line in lines:
+        if b"X:" in line:
+            position = _parse_m114(line)
+            break
     return jsonify({
         "ok": True,
-        "note": "For exact coords, extend SerialManager to read M114 response.",
+        "position": position,
         "anchor": STATE.anchor,
         "feed_xy": STATE.feed_xy,
         "feed_z": STATE.feed_z,
@@ -202,7 +281,7 @@ def printer_stop():
 
 @app.post("/config")
 def update_config():
-    data = request.get_json(force=True, silent=True) or {}
+    data = _json_body()
     if "feed_xy" in data:
         try:
             STATE.feed_xy = max(1, int(data["feed_xy"]))
@@ -226,16 +305,33 @@ def update_config():
 
 @app.get("/camera/metadata")
 def camera_metadata():
-    return jsonify({"metadata": STATE.camera.get_metadata()})
+    return jsonify({"metadata": _ensure_camera().get_metadata()})
 
 
 @app.post("/camera/controls")
 def camera_controls():
-    data = request.get_json(force=True, silent=True) or {}
-    STATE.camera.set_controls(data)
+    data = _json_body()
+    try:
+        _ensure_camera().set_controls(data)
+    except (TypeError, ValueError) as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
     return jsonify({"ok": True})
 
 
+@app.route("/camera/encoder", methods=["GET", "POST"])
+def camera_encoder():
+    camera = _ensure_camera()
+    if request.method == "POST":
+        data = _json_body()
+        try:
+            camera.set_encoder(bitrate=data.get("bitrate"), quality=data.get("quality"))
+        except (TypeError, ValueError) as e:
+            return jsonify({"ok": False, "error": str(e)}), 400
+        except Exception as e:
+            return jsonify({"ok": False, "error": str(e)}), 500
+    return jsonify({"ok": True, "encoder": camera.encoder_settings()})
+
+
 @app.get("/camera/defaults")
 def camera_defaults_get():
     data: Dict[str, Any] = {}
@@ -250,17 +346,17 @@ def camera_defaults_get():
 
 @app.post("/camera/defaults")
 def camera_defaults_set():
-    body = request.get_json(force=True, silent=True) or {}
+    body = _json_body()
     # Accept either {"defaults": {...}} or a flat dict of controls
-    defaults = body.get("defaults") if isinstance(body, dict) else None
+    defaults = body.get("defaults")
     if not isinstance(defaults, dict):
-        defaults = body if isinstance(body, dict) else {}
+        defaults = body
     apply_now = bool(body.get("apply", True))
     try:
         with open(CAM_DEFAULTS_PATH, "w", encoding="utf-8") as f:
             json.dump(defaults, f, indent=2)
         if apply_now and isinstance(defaults, dict) and defaults:
-            STATE.camera.set_controls(defaults)
+            _ensure_camera().set_controls(defaults)
         return jsonify({"ok": True})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
@@ -284,10 +380,12 @@ def camera_caps():
         "contrast",
         "saturation",
         "sharpness",
+        "encoder_bitrate",
+        "encoder_quality",
     ]
     return jsonify({
         "controls_supported": controls_supported,
-        "metadata": STATE.camera.get_metadata(),
+        "metadata": _ensure_camera().get_metadata(),
     })
 
 
@@ -295,7 +393,7 @@ def camera_caps():
 def preview_full():
     headers = {"Age": "0", "Cache-Control": "no-cache, private", "Pragma": "no-cache"}
     return Response(
-        mjpeg_stream(STATE.camera.output, transform=False),
+        mjpeg_stream(_ensure_camera().output, transform=False),
         mimetype="multipart/x-mixed-replace; boundary=frame",
         headers=headers,
         direct_passthrough=True,
@@ -315,7 +413,7 @@ def preview_crop():
     headers = {"Age": "0", "Cache-Control": "no-cache, private", "Pragma": "no-cache"}
     return Response(
         mjpeg_stream(
-            STATE.camera.output, transform=True, cw=cw, ch=ch, ox=ox, oy=oy, flip=flip, quality=quality, fps=fps
+            _ensure_camera().output, transform=True, cw=cw, ch=ch, ox=ox, oy=oy, flip=flip, quality=quality, fps=fps
         ),
         mimetype="multipart/x-mixed-replace; boundary=frame",
         headers=headers,
@@ -334,20 +432,19 @@ def capture():
     flip = str(args.get("flip", "1")).lower() in ("1", "true", "yes")
     quality = int(args.get("quality", 85))
     save = str(args.get("save", "0")).lower() in ("1", "true", "yes")
-    session = args.get("session") or datetime.now().strftime("%Y%m%d")
+    session = args.get("session") or timestamp()[:8]
 
-    img = STATE.camera.capture_jpeg_bytes()
+    img = _ensure_camera().capture_jpeg_bytes()
     payload = transform_jpeg(img, mode=mode, cw=cw, ch=ch, ox=ox, oy=oy, flip=flip, quality=quality)
 
     headers = {"Cache-Control": "no-store", "Content-Disposition": 'inline; filename="capture.jpg"'}
     if save:
         dir_path = os.path.join(CAPTURES_DIR, session)
-        os.makedirs(dir_path, exist_ok=True)
-        ts = datetime.now().strftime("%H%M%S_%f")
+        _ensure_dir(dir_path)
+        ts = timestamp()[9:]  # HHMMSS_ffffff
         name = f"img_{ts}.jpg"
         out_path = os.path.join(dir_path, name)
-        with open(out_path, "wb") as f:
-            f.write(payload)
+        _queue_write(out_path, payload)
         headers["X-Saved-Filename"] = name
         headers["X-Saved-Url"] = f"/captures/{session}/{name}"
     return Response(payload, mimetype="image/jpeg", headers=headers)
@@ -360,7 +457,7 @@ def serve_captures(subpath: str):
 
 @app.post("/macro/move_and_capture")
 def macro_move_and_capture():
-    data = request.get_json(force=True, silent=True) or {}
+    data = _json_body()
     # Motion
     x = data.get("x")
     y = data.get("y")
@@ -379,61 +476,87 @@ def macro_move_and_capture():
     oy = int(cap.get("oy", 200))
     flip = bool(cap.get("flip", True))
     quality = int(cap.get("quality", 85))
-    ret_mode = str(cap.get("return", "path")).lower()  # path|inline_base64
+    ret_mode = str(cap.get("return", "path")).lower()  # path|inline_base64|binary
     save = bool(cap.get("save", True))
-    session = cap.get("session") or datetime.now().strftime("%Y%m%d")
+    session = cap.get("session") or timestamp()[:8]
 
     # Ensure serial + move
     sm = _ensure_serial()
-    cmds = ["G90"]
+    cmds = [b"G90"]
     if x is not None or y is not None:
-        parts = ["G0", f"F{feed_xy}"]
-        if x is not None:
-            parts.append(f"X{float(x):.4f}")
-        if y is not None:
-            parts.append(f"Y{float(y):.4f}")
-        cmds.append(" ".join(parts))
+        xpart = b" X%.4f" % float(x) if x is not None else b""
+        ypart = b" Y%.4f" % float(y) if y is not None else b""
+        cmds.append(b"G0 F%d%s%s" % (feed_xy, xpart, ypart))
     if z is not None:
-        cmds.append(f"G0 F{feed_z} Z{float(z):.4f}")
+        cmds.append(b"G0 F%d Z%.4f" % (feed_z, float(z)))
     if wait:
-        cmds.append("M400")
-    sm.send_commands(cmds, wait_ok=True)
+        cmds.append(b"M400")
+    sm.send_batch(cmds)
 
     # Apply camera controls + settle
     if cam_ctrl:
-        STATE.camera.set_controls(cam_ctrl)
+        _ensure_camera().set_controls(cam_ctrl)
     if settle > 0:
         time.sleep(settle)
 
     # Capture
-    img = STATE.camera.capture_jpeg_bytes()
+    img = _ensure_camera().capture_jpeg_bytes()
     payload = transform_jpeg(img, mode=mode, cw=cw, ch=ch, ox=ox, oy=oy, flip=flip, quality=quality)
 
     # Save if requested
     saved_path = None
     if save:
         dir_path = os.path.join(CAPTURES_DIR, session)
-        os.makedirs(dir_path, exist_ok=True)
-        ts = datetime.now().strftime("%H%M%S_%f")
+        _ensure_dir(dir_path)
+        ts = timestamp()[9:]  # HHMMSS_ffffff
         name = f"img_{ts}.jpg"
         saved_path = os.path.join(dir_path, name)
-        with open(saved_path, "wb") as f:
-            f.write(payload)
-
+        _queue_write(saved_path, payload)
+
+    if ret_mode == "binary":
+        # Raw JPEG; saved path (if any) travels in a header
+        headers = {"Cache-Control": "no-store", "Content-Disposition": 'inline; filename="capture.jpg"'}
+        if saved_path:
+            headers["X-Saved-Path"] = saved_path
+        return Response(payload, mimetype="image/jpeg", headers=headers)
     if ret_mode == "inline_base64":
-        b64 = base64.b64encode(payload).decode("ascii")
-        return jsonify({"ok": True, "image_base64": b64, "path": saved_path})
+        # Assemble the JSON around the base64 bytes directly instead of
+        # round-tripping a multi-MB str through jsonify.
+        body = b"".join((
+            b'{"ok":true,"image_base64":"',
+            base64.b64encode(payload),
+            b'","path":',
+            json.dumps(saved_path).encode(),
+            b"}",
+        ))
+        return Response(body, mimetype="application/json")
     else:
         return jsonify({"ok": True, "path": saved_path})
 
 
 def run():  # pragma: no cover
     port = int(os.environ.get("PORT", "8500"))
-    app.run(host="0.0.0.0", port=port, threaded=True)
+    threads = int(os.environ.get("THREADS", "16"))
+    try:
+        from waitress import serve
+    except ImportError:
+        # Fall back to Flask's dev server when waitress isn't installed
+        app.run(host="0.0.0.0", port=port, threaded=True)
+        return
+    # Bounded worker pool; each open preview stream holds one thread
+    # Small per-connection output buffers: once a slow viewer has ~256 KiB
+    # queued the stream thread blocks (and then skips to the newest frame)
+    # instead of waitress buffering seconds of stale frames or spilling
+    # them to a tempfile on the SD card
+    serve(app, host="0.0.0.0", port=port, threads=threads,
+          channel_timeout=120, asyncore_use_poll=True,
+          outbuf_high_watermark=256 * 1024, outbuf_overflow=512 * 1024)
 
 
 def _shutdown(*_):  # pragma: no cover
     try:
+        # Flush captures still waiting on the writer thread
+        _WRITE_QUEUE.join()
         with STATE.serial_lock:
             if STATE.serial:
                 try:
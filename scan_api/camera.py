@@ -1,36 +1,119 @@
 import io
+import logging
 import os
+import struct
 import threading
 import time
-from datetime import datetime
 from typing import Generator, Optional, Tuple
 
-from PIL import Image, ImageOps
-
-from picamera2 import Picamera2
-from picamera2.encoders import MJPEGEncoder
-from picamera2.outputs import FileOutput
-
 try:
     from libcamera import controls  # type: ignore
 except Exception:  # pragma: no cover
     controls = None
 
+# Friendly name -> enum lookups, built once rather than per control request
+if controls is not None:
+    _AF_MODE_MAP = {
+        "manual": controls.AfModeEnum.Manual,
+        "auto": controls.AfModeEnum.Auto,
+        "continuous": controls.AfModeEnum.Continuous,
+    }
+    _AF_TRIGGER_MAP = {
+        "start": controls.AfTriggerEnum.Start,
+        "cancel": controls.AfTriggerEnum.Cancel,
+    }
+else:  # pragma: no cover
+    _AF_MODE_MAP = {}
+    _AF_TRIGGER_MAP = {}
+
+# PIL, picamera2 and libjpeg-turbo are imported on first use, so the Flask
+# routes (and anything else importing this module) don't pay for them up front.
+_PIL = None
+_TJ = None
+_TJ_LOADED = False
+_TJ_FAILURE_LOGGED = False
+
+log = logging.getLogger(__name__)
+
+
+def _get_pil():
+    """Return ``(Image, ImageOps)``, importing PIL on first call."""
+    global _PIL
+    if _PIL is None:
+        from PIL import Image, ImageOps
+        _PIL = (Image, ImageOps)
+    return _PIL
+
+
+def _get_tj():
+    """Return ``(TurboJPEG(), tjMCUWidth, tjMCUHeight)``, or None without it."""
+    global _TJ, _TJ_LOADED
+    if not _TJ_LOADED:
+        try:
+            # Optional: libjpeg-turbo (SIMD) for crop/flip; PIL is used without it
+            from turbojpeg import TurboJPEG, tjMCUHeight, tjMCUWidth  # type: ignore
+            _TJ = (TurboJPEG(), tjMCUWidth, tjMCUHeight)
+        except Exception:  # pragma: no cover
+            _TJ = None
+        _TJ_LOADED = True
+    return _TJ
+
+
+def timestamp() -> str:
+    """Local time as ``YYYYmmdd_HHMMSS_ffffff`` (``strftime("%Y%m%d_%H%M%S_%f")``).
+
+    Built from integer fields; strftime is noticeably slower in rapid capture loops.
+    """
+    ns = time.time_ns()
+    us = (ns // 1000) % 1_000_000
+    t = time.localtime(ns // 1_000_000_000)
+    return (
+        f"{t.tm_year:04d}{t.tm_mon:02d}{t.tm_mday:02d}_"
+        f"{t.tm_hour:02d}{t.tm_min:02d}{t.tm_sec:02d}_{us:06d}"
+    )
+
 
 class StreamingOutput(io.BufferedIOBase):
     def __init__(self):
-        self.frame: Optional[bytes] = None
-        self.condition = threading.Condition()
+        # Latest (frame, seq) pair; replaced with a single attribute assignment
+        # so readers always see a matching frame and sequence number.
+        self.latest: Tuple[Optional[bytes], int] = (None, 0)
+        # Set once when the next frame lands, then replaced by a fresh event
+        self.event = threading.Event()
+
+    @property
+    def frame(self) -> Optional[bytes]:
+        return self.latest[0]
+
+    @property
+    def seq(self) -> int:
+        return self.latest[1]
 
     def writable(self) -> bool:  # type: ignore[override]
         return True
 
     def write(self, buf: bytes) -> int:  # type: ignore[override]
-        with self.condition:
-            self.frame = bytes(buf)
-            self.condition.notify_all()
+        # Each write is a complete JPEG; FileOutput hands us immutable bytes
+        frame = buf if isinstance(buf, bytes) else bytes(buf)
+        self.latest = (frame, self.latest[1] + 1)
+        # Swap in a fresh event before waking readers so late arrivals
+        # block until the frame after this one.
+        event, self.event = self.event, threading.Event()
+        event.set()
         return len(buf)
 
+    def wait_frame(self, last_seq: int, timeout: Optional[float] = None) -> Tuple[Optional[bytes], int]:
+        """Block until a frame newer than ``last_seq`` is published.
+
+        Returns the latest ``(frame, seq)``; ``seq == last_seq`` on timeout.
+        """
+        event = self.event
+        latest = self.latest
+        if latest[1] != last_seq:
+            return latest
+        event.wait(timeout)
+        return self.latest
+
 
 class CameraController:
     def __init__(self, index: int = 0, label: Optional[str] = None,
@@ -38,24 +121,97 @@ class CameraController:
         self.index = index
         self.label = label or f"camera_{index}"
         self.lock = threading.RLock()
+        from picamera2 import Picamera2
+        from picamera2.encoders import MJPEGEncoder, Quality
         self.picam2 = Picamera2(camera_num=index)
 
-        # Simple configurations: low-res preview + still mode
-        self.preview_config = self.picam2.create_video_configuration(
-            main={"size": preview_size}
-        )
-        # Use still configuration; Picamera2 will JPEG-encode capture_file
-        self.still_config = self.picam2.create_still_configuration(
-            main={"size": self.picam2.sensor_resolution or preview_size}
+        # One configuration, two streams: full-res "main" for stills and a
+        # low-res "lores" feeding the MJPEG preview, so capturing a still never
+        # stops the encoder or switches modes. Every buffer is allocated up
+        # front from CMA, so keep them few: two full-res RGB888 buffers
+        # (~37 MB each at 12 MP) and no raw stream, which stills don't use.
+        # A video configuration defaults to Fast noise reduction; ask for the
+        # still configuration's HighQuality so captures match a still-mode shot.
+        cfg_controls = {}
+        nr = self._nr_mode_value("high_quality")
+        if nr is not None:
+            cfg_controls["NoiseReductionMode"] = nr
+        self.config = self.picam2.create_video_configuration(
+            main={"size": self.picam2.sensor_resolution or preview_size, "format": "RGB888"},
+            lores={"size": preview_size},
+            raw=None,
+            encode="lores",
+            buffer_count=2,
+            controls=cfg_controls,
         )
 
-        self.picam2.configure(self.preview_config)
+        self.picam2.configure(self.config)
 
         self.output = StreamingOutput()
         self.encoder = MJPEGEncoder()
+        # Encoder tuning; an explicit bitrate takes precedence over quality
+        self.encoder_bitrate: Optional[int] = None
+        self.encoder_quality = Quality.MEDIUM
 
         self.picam2.start()
-        self.picam2.start_recording(self.encoder, FileOutput(self.output))
+        self._start_recording()
+
+    def _start_recording(self):
+        self._start_with_fallback(self.picam2.start_recording)
+
+    def _start_with_fallback(self, start):
+        # ``start`` is picam2.start_recording or picam2.start_encoder. The
+        # hardware MJPEGEncoder only opens its V4L2 device when it starts, so
+        # that is where a missing device shows up; retry once with the
+        # software JpegEncoder. (Recent Picamera2 already substitutes a libav
+        # encoder for MJPEGEncoder on hardware without the V4L2 block.)
+        from picamera2.encoders import JpegEncoder
+        from picamera2.outputs import FileOutput
+        try:
+            start(self.encoder, FileOutput(self.output), quality=self._recording_quality())
+        except Exception:
+            if isinstance(self.encoder, JpegEncoder):
+                raise
+            self.encoder = JpegEncoder()
+            start(self.encoder, FileOutput(self.output), quality=self._recording_quality())
+
+    def set_encoder(self, bitrate=None, quality=None):
+        """Restart the MJPEG encoder with a new bitrate (bits/s) or quality.
+
+        Lower settings cut both encode work and bytes per preview frame.
+        A bitrate of 0 clears it so the quality preset applies again.
+        """
+        with self.lock:
+            new_bitrate = self.encoder_bitrate
+            new_quality = self.encoder_quality
+            if bitrate is not None:
+                new_bitrate = int(bitrate)
+                if new_bitrate < 0:
+                    raise ValueError(f"bitrate must be >= 0, got {bitrate!r}")
+                new_bitrate = new_bitrate or None
+            if quality is not None:
+                new_quality = self._encoder_quality_value(quality)
+            if new_bitrate == self.encoder_bitrate and new_quality == self.encoder_quality:
+                # Unchanged settings; don't tear down a running encoder
+                return
+            self.encoder_bitrate = new_bitrate
+            self.encoder_quality = new_quality
+            try:
+                self.picam2.stop_encoder()
+            except Exception:
+                pass
+            from picamera2.encoders import MJPEGEncoder
+            self.encoder = MJPEGEncoder(bitrate=self.encoder_bitrate)
+            # Only the encoder restarts; the camera keeps running
+            self._start_with_fallback(self.picam2.start_encoder)
+
+    def _recording_quality(self):
+        # Picamera2 derives the bitrate from quality whenever one is passed,
+        # so leave it out when an explicit bitrate is set
+        return None if self.encoder_bitrate else self.encoder_quality
+
+    def encoder_settings(self) -> dict:
+        return {"bitrate": self.encoder_bitrate, "quality": self.encoder_quality.name.lower()}
 
     def get_metadata(self) -> dict:
         try:
@@ -66,10 +222,13 @@ class CameraController:
 
     def set_controls(self, ctrl: dict):
         m = {}
+        encoder = {}
         for k, v in (ctrl or {}).items():
             if v is None:
                 continue
-            if k == "exposure_time":
+            if k in ("encoder_bitrate", "encoder_quality"):
+                encoder[k[len("encoder_"):]] = v
+            elif k == "exposure_time":
                 m["ExposureTime"] = int(v)
             elif k in ("analogue_gain", "analog_gain"):
                 m["AnalogueGain"] = float(v)
@@ -97,35 +256,29 @@ class CameraController:
                 m[k.capitalize()] = float(v)
             else:
                 m[k] = v
+        if encoder:
+            self.set_encoder(**encoder)
         if not m:
             return
         with self.lock:
             self.picam2.set_controls(m)
 
-    def _af_mode_value(self, v):
-        if controls is None:
-            return v
+    def _encoder_quality_value(self, v):
+        from picamera2.encoders import Quality
+        # Accept preset names such as "low" or "very_high", or the enum's int
+        # value; anything else raises ValueError
         if isinstance(v, str):
-            name = v.strip().lower()
-            mapping = {
-                "manual": controls.AfModeEnum.Manual,
-                "auto": controls.AfModeEnum.Auto,
-                "continuous": controls.AfModeEnum.Continuous,
-            }
-            return mapping.get(name, v)
-        return v
+            name = v.strip().upper().replace("-", "_").replace(" ", "_")
+            if name not in Quality.__members__:
+                raise ValueError(f"unknown encoder quality {v!r}")
+            return Quality[name]
+        return Quality(int(v))
+
+    def _af_mode_value(self, v):
+        return _AF_MODE_MAP.get(v.strip().lower(), v) if isinstance(v, str) else v
 
     def _af_trigger_value(self, v):
-        if controls is None:
-            return v
-        if isinstance(v, str):
-            name = v.strip().lower()
-            mapping = {
-                "start": controls.AfTriggerEnum.Start,
-                "cancel": controls.AfTriggerEnum.Cancel,
-            }
-            return mapping.get(name, v)
-        return v
+        return _AF_TRIGGER_MAP.get(v.strip().lower(), v) if isinstance(v, str) else v
 
     def _awb_mode_value(self, v):
         # Map string names to libcamera enums; skip if unknown to avoid type errors
@@ -181,66 +334,30 @@ class CameraController:
     # Capture utilities
 
     def capture_jpeg_bytes(self) -> bytes:
-        import tempfile
         with self.lock:
-            try:
-                self.picam2.stop_recording()
-            except Exception:
-                pass
-            self.picam2.switch_mode(self.still_config)
+            # Stills come from the full-res stream; the preview keeps running
             buf = io.BytesIO()
-            data: Optional[bytes] = None
             try:
-                try:
-                    self.picam2.capture_file(buf, format='jpeg')  # type: ignore[arg-type]
-                    data = buf.getvalue()
-                except TypeError:
-                    buf.seek(0)
-                    self.picam2.capture_file(buf)  # type: ignore[arg-type]
-                    data = buf.getvalue()
-            except Exception:
-                tmp = tempfile.NamedTemporaryFile(suffix='.jpg', delete=False)
-                tmp_path = tmp.name
-                tmp.close()
-                try:
-                    self.picam2.capture_file(tmp_path)
-                    with open(tmp_path, 'rb') as f:
-                        data = f.read()
-                finally:
-                    try:
-                        os.unlink(tmp_path)
-                    except Exception:
-                        pass
-            finally:
-                self.picam2.switch_mode(self.preview_config)
-                try:
-                    self.picam2.start_recording(self.encoder, FileOutput(self.output))
-                except Exception:
-                    pass
-        return data or b''
+                self.picam2.capture_file(buf, name="main", format='jpeg')  # type: ignore[arg-type]
+            except TypeError:
+                buf.seek(0)
+                buf.truncate()
+                self.picam2.capture_file(buf, name="main")  # type: ignore[arg-type]
+            return buf.getvalue()
 
     def capture_file(self, dir_path: str) -> str:
         os.makedirs(dir_path, exist_ok=True)
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        ts = timestamp()
         filename = f"{self.label}_{ts}.jpg"
         path = os.path.join(dir_path, filename)
         with self.lock:
-            try:
-                self.picam2.stop_recording()
-            except Exception:
-                pass
-            self.picam2.switch_mode(self.still_config)
-            self.picam2.capture_file(path)
-            self.picam2.switch_mode(self.preview_config)
-            try:
-                self.picam2.start_recording(self.encoder, FileOutput(self.output))
-            except Exception:
-                pass
+            self.picam2.capture_file(path, name="main")
         return path
 
 
-def crop_from_center(img: Image.Image, cw: int, ch: int, ox: int = 0, oy: int = 0) -> Image.Image:
-    w, h = img.size
+def _crop_box(w: int, h: int, cw: int, ch: int, ox: int = 0, oy: int = 0) -> Optional[Tuple[int, int, int, int]]:
+    # (left, top, right, bottom) of a cw x ch box centred on the image, offset
+    # by (ox, oy) and clamped to bounds; None if nothing of it is left.
     cx = w // 2
     cy = h // 2
     left = int(cx - cw / 2 + ox)
@@ -253,16 +370,123 @@ def crop_from_center(img: Image.Image, cw: int, ch: int, ox: int = 0, oy: int =
     right = max(0, min(right, w))
     bottom = max(0, min(bottom, h))
     if right <= left or bottom <= top:
+        return None
+    return left, top, right, bottom
+
+
+# Start-of-frame markers (baseline, progressive, ...); C4/C8/CC are not SOFs
+_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def _jpeg_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """(width, height) from a JPEG's SOF header, or None if it can't be found."""
+    if data[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    n = len(data)
+    while i + 4 <= n:
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            i += 1
+            continue
+        (seg_len,) = struct.unpack_from(">H", data, i + 2)
+        if marker in _SOF_MARKERS:
+            if i + 9 > n:
+                return None
+            h, w = struct.unpack_from(">HH", data, i + 5)
+            return w, h
+        if marker == 0xDA:
+            # Start of scan: entropy-coded data follows, no SOF before it
+            return None
+        i += 2 + seg_len
+    return None
+
+
+def crop_from_center(img, cw: int, ch: int, ox: int = 0, oy: int = 0):
+    # PIL image in, PIL image out
+    box = _crop_box(img.size[0], img.size[1], cw, ch, ox, oy)
+    if box is None:
         return img.copy()
-    return img.crop((left, top, right, bottom))
+    return img.crop(box)
+
+
+def _transform_jpeg_turbo(jpeg_bytes: bytes, mode: str, cw: int, ch: int, ox: int, oy: int,
+                          flip: bool, quality: int, scratch: Optional[dict] = None,
+                          lossless: bool = False) -> Optional[bytes]:
+    # Returns None when libjpeg-turbo can't produce the exact box, so the
+    # caller does that frame with PIL instead
+    tj, tjMCUWidth, tjMCUHeight = _get_tj()
+    w, h, subsample, _ = tj.decode_header(jpeg_bytes)
+    box = None if mode == "full" else _crop_box(w, h, cw, ch, ox, oy)
+    if box is not None:
+        left, top, right, bottom = box
+        mcu_w, mcu_h = tjMCUWidth[subsample], tjMCUHeight[subsample]
+        if lossless and not flip and left % mcu_w == 0 and top % mcu_h == 0:
+            # MCU-aligned crop works on DCT coefficients: no decode, no
+            # re-encode, but the source quality is kept rather than ``quality``
+            out = tj.crop(jpeg_bytes, left, top, right - left, bottom - top)
+            if tj.decode_header(out)[:2] != (right - left, bottom - top):
+                return None
+            return out
+        # Cut the MCU-aligned region around the box in the DCT domain first,
+        # so only the crop (not the full frame) is decoded for the pixel work
+        ax = left - left % mcu_w
+        ay = top - top % mcu_h
+        jpeg_bytes = tj.crop(jpeg_bytes, ax, ay, right - ax, bottom - ay)
+        box = (left - ax, top - ay, right - ax, bottom - ay)
+        # PyTurboJPEG 1.x drops a partial MCU at the right/bottom image edge
+        # rather than keeping it, so the cut can come back short of the box
+        w, h, _, _ = tj.decode_header(jpeg_bytes)
+        if box[2] > w or box[3] > h:
+            return None
+    dst = scratch.get("decode") if scratch is not None else None
+    if dst is not None and dst.shape[:2] != (h, w):
+        dst = None
+    # Decode into the caller's array from the previous frame when the size
+    # matches, instead of allocating a fresh frame-sized array every time
+    arr = tj.decode(jpeg_bytes, dst=dst)
+    if scratch is not None:
+        scratch["decode"] = arr
+    if box is not None:
+        # Box is relative to the pre-cut region
+        left, top, right, bottom = box
+        arr = arr[top:bottom, left:right]
+    if flip:
+        # encode() wants C-contiguous rows, so the reversed view is copied
+        arr = arr[::-1].copy()
+    return tj.encode(arr, quality=quality)
 
 
 def transform_jpeg(jpeg_bytes: bytes, *, mode: str = "crop",
                    cw: int = 1400, ch: int = 1400, ox: int = 0, oy: int = 200,
-                   flip: bool = True, quality: int = 85) -> bytes:
+                   flip: bool = True, quality: int = 85,
+                   scratch: Optional[dict] = None, lossless: bool = False) -> bytes:
+    # ``scratch`` is a per-caller dict (e.g. one per stream) that keeps the
+    # libjpeg-turbo decode array alive between calls; not thread-safe.
+    # ``lossless`` lets block-aligned crops skip re-encoding at ``quality``.
+    global _TJ_FAILURE_LOGGED
+    if mode == "full" and not flip:
+        # Nothing to change; skip the decode/encode round trip
+        return jpeg_bytes
+    quality = max(1, min(100, int(quality)))
+    if _get_tj() is not None:
+        try:
+            out = _transform_jpeg_turbo(jpeg_bytes, mode, cw, ch, ox, oy, flip, quality,
+                                        scratch, lossless)
+            if out is not None:
+                return out
+        except Exception:
+            # Log once; a broken turbo path would otherwise fall back quietly
+            # on every frame
+            if not _TJ_FAILURE_LOGGED:
+                _TJ_FAILURE_LOGGED = True
+                log.exception("libjpeg-turbo transform failed; using PIL")
+    Image, ImageOps = _get_pil()
     with Image.open(io.BytesIO(jpeg_bytes)) as im:
         im.load()
-        out: Image.Image
         if mode == "full":
             out = im
         elif mode == "both":
@@ -273,40 +497,70 @@ def transform_jpeg(jpeg_bytes: bytes, *, mode: str = "crop",
         if flip:
             out = ImageOps.flip(out)
         buf = io.BytesIO()
-        out.save(buf, format="JPEG", quality=max(1, min(100, int(quality))))
+        out.save(buf, format="JPEG", quality=quality)
         return buf.getvalue()
 
 
+# Multipart part header; the CRLF that ends the previous part leads the
+# boundary so each frame needs just this small header plus the JPEG itself.
+_MJPEG_PART_HEADER = b"\r\n--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n"
+
+
+# Upper bound on a single wait for the next preview frame
+_FRAME_WAIT_SEC = 0.25
+
+
 def mjpeg_stream(output: StreamingOutput, *,
                  transform: bool = False,
                  cw: int = 1400, ch: int = 1400, ox: int = 0, oy: int = 200,
                  flip: bool = False, quality: int = 75, fps: int = 8) -> Generator[bytes, None, None]:
-    boundary = b"--frame"
     min_interval = 1.0 / max(1, int(fps))
-    last = 0.0
+    deadline = time.monotonic()
+    # Decided once per session: a non-positive crop size leaves the frame
+    # whole, so without a flip there is nothing to transform
+    transform = transform and (flip or (cw > 0 and ch > 0))
+    # Per-connection scratch space; holds the decode array across frames
+    scratch: Optional[dict] = {} if transform else None
+    # A crop that covers the whole frame is a no-op too, but that needs the
+    # stream's frame size, so it's checked on the first frame
+    check_size = transform and not flip
+    last_seq = output.seq
     while True:
-        with output.condition:
-            output.condition.wait()
-            frame = output.frame
-        if frame is None:
+        # Sleep straight through to the next send slot; frames that land in
+        # the meantime are simply overwritten, so they never cost a wake-up
+        # or any decode work.
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        # Latest-only: read whatever is newest at wake-up and never drain
+        # older frames, so a slow client just skips frames the writer has
+        # already overwritten. The timeout keeps a stalled camera from
+        # parking the generator indefinitely.
+        frame, seq = output.wait_frame(last_seq, _FRAME_WAIT_SEC)
+        if seq == last_seq:
             continue
-        now = time.time()
-        if now - last < min_interval:
+        last_seq = seq
+        if frame is None:
             continue
-        last = now
+        if check_size:
+            check_size = False
+            size = _jpeg_size(frame)
+            if size is not None and _crop_box(size[0], size[1], cw, ch, ox, oy) == (0, 0) + size:
+                # Re-encoding would only lose quality; stream frames as-is
+                transform = False
         data = frame
         if transform:
             try:
                 data = transform_jpeg(
-                    frame, mode="crop", cw=cw, ch=ch, ox=ox, oy=oy, flip=flip, quality=quality
+                    frame, mode="crop", cw=cw, ch=ch, ox=ox, oy=oy, flip=flip, quality=quality,
+                    scratch=scratch, lossless=True,
                 )
             except Exception:
                 data = frame
-        yield (
-            boundary
-            + b"\r\nContent-Type: image/jpeg\r\nContent-Length: "
-            + str(len(data)).encode()
-            + b"\r\n\r\n"
-            + data
-            + b"\r\n"
-        )
+        # No header + frame concatenation per part; waitress still copies
+        # both chunks into its per-connection output buffer.
+        yield _MJPEG_PART_HEADER % len(data)
+        yield data
+        # Absolute cadence; if a slow client fell behind, restart the
+        # schedule from now rather than bursting to catch up
+        deadline = max(deadline + min_interval, time.monotonic())
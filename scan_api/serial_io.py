@@ -1,6 +1,7 @@
+import re
 import threading
 import time
-from typing import Iterable, Optional
+from typing import Iterable, List, Optional, Union
 
 
 try:
@@ -9,12 +10,21 @@ except Exception:  # pragma: no cover
     serial = None  # type: ignore
 
 
+# "ok" alone, "ok" followed by extras (ADVANCED_OK "ok N.. P.. B.."), or a
+# line ending in " ok"; matched against the lowercased, stripped line
+_OK_RE = re.compile(rb"^ok\b|\sok$")
+
+
 class SerialManager:
     """Minimal pyserial wrapper for Marlin/RepRap style 'ok' protocol."""
 
     def __init__(self):
         self._ser: Optional[serial.Serial] = None  # type: ignore
         self._lock = threading.Lock()
+        # Received bytes not yet split into lines
+        self._rx = bytearray()
+        # Updated only by connect/disconnect so status polls can read it lock-free
+        self.connected = False
 
     def connect(self, port: str, baud: int = 115200, timeout: float = 1.0):
         if serial is None:
@@ -24,6 +34,8 @@ class SerialManager:
         time.sleep(2.0)
         with self._lock:
             self._ser = ser
+            self._rx.clear()
+            self.connected = ser.is_open
 
     def disconnect(self):
         with self._lock:
@@ -34,37 +46,87 @@ class SerialManager:
                     pass
                 self._ser.close()
             self._ser = None
+            self._rx.clear()
+            self.connected = False
 
     def is_connected(self) -> bool:
         with self._lock:
             return bool(self._ser and self._ser.is_open)
 
-    def _write_line(self, line: str):
+    @staticmethod
+    def _encode(line: Union[str, bytes]) -> bytes:
+        # G-code is plain ASCII; pre-encoded bytes pass straight through
+        if isinstance(line, bytes):
+            return line.strip()
+        return line.strip().encode("ascii")
+
+    def _write_line(self, line: Union[str, bytes]):
         if self._ser is None:
             raise RuntimeError("serial not connected")
-        payload = (line.strip() + "\n").encode("ascii")
+        payload = self._encode(line) + b"\n"
         self._ser.write(payload)
         self._ser.flush()
 
-    def _read_until_ok(self, timeout: float = 5.0):
+    def _readline(self) -> bytes:
+        # Take whatever the port has buffered in one read and split lines out
+        # of it; only block (up to the port timeout) when nothing is waiting.
+        # Returns b"" on timeout, keeping any partial line for the next call.
+        ser = self._ser
+        rx = self._rx
+        while True:
+            idx = rx.find(b"\n")
+            if idx >= 0:
+                line = bytes(rx[:idx])
+                del rx[:idx + 1]
+                return line
+            chunk = ser.read(ser.in_waiting or 1)
+            if not chunk:
+                return b""
+            rx += chunk
+
+    def _read_until_ok(self, timeout: float = 5.0, lines: Optional[List[bytes]] = None):
         if self._ser is None:
             raise RuntimeError("serial not connected")
-        ser = self._ser
-        start = time.time()
-        while time.time() - start < timeout:
-            line = ser.readline()
-            if not line:
-                continue
-            low = line.strip().lower()
-            if low == b"ok" or low.endswith(b" ok"):
-                return
-            # ignore informational lines
-        raise TimeoutError("Timeout waiting for ok from printer")
-
-    def send_commands(self, commands: Iterable[str], wait_ok: bool = True):
+        deadline = time.monotonic() + timeout
+        while True:
+            line = self._readline().strip()
+            if line:
+                if _OK_RE.search(line.lower()):
+                    return
+                # informational lines are ignored unless the caller collects them
+                if lines is not None:
+                    lines.append(line)
+            if time.monotonic() >= deadline:
+                raise TimeoutError("Timeout waiting for ok from printer")
+
+    def send_commands(self, commands: Iterable[Union[str, bytes]], wait_ok: bool = True):
         with self._lock:
             for cmd in commands:
                 self._write_line(cmd)
                 if wait_ok:
                     self._read_until_ok()
 
+    def send_batch(self, commands: Iterable[Union[str, bytes]], timeout: float = 5.0):
+        """Write several commands in one serial write, then read one 'ok' per line.
+
+        Saves a round-trip per line versus send_commands. Keep batches to a
+        handful of short lines so they fit in the firmware's receive buffer.
+        """
+        lines = [line for line in map(self._encode, commands) if line]
+        if not lines:
+            return
+        with self._lock:
+            if self._ser is None:
+                raise RuntimeError("serial not connected")
+            self._ser.write(b"\n".join(lines) + b"\n")
+            self._ser.flush()
+            for _ in lines:
+                self._read_until_ok(timeout)
+
+    def query(self, command: str, timeout: float = 5.0) -> List[bytes]:
+        """Send one command and return the response lines printed before 'ok'."""
+        lines: List[bytes] = []
+        with self._lock:
+            self._write_line(command)
+            self._read_until_ok(timeout, lines)
+        return lines
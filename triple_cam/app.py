@@ -1,6 +1,7 @@
 import os
 import signal
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Generator
 
@@ -14,12 +15,29 @@ import tempfile
 
 from .camera_manager import CameraManager
 
+try:
+    # Optional: keeps /api/history in memory instead of listing the directory per request
+    from inotify_simple import INotify, flags as inotify_flags  # type: ignore
+except Exception:  # pragma: no cover
+    INotify = None
+
 
 APP_PORT = int(os.environ.get("PORT", "8010"))
+APP_THREADS = int(os.environ.get("THREADS", "16"))
 CAPTURES_DIR = os.path.join(os.path.dirname(__file__), "captures")
 
+# Extensions stored as-is in zip downloads
+_COMPRESSED_EXT = ('.jpg', '.jpeg', '.png', '.zip', '.gz')
+# Extensions picked up by zip_all
+_IMG_EXT = ('.jpg', '.jpeg', '.png')
+# Capture names end in _YYYYmmdd_HHMMSS_ffffff.(jpg|png); the timestamp groups a set
+_HIST_RE = re.compile(r"_(\d{8}_\d{6}_\d{6})\.(jpg|png)$", re.IGNORECASE)
+_TS_RE = re.compile(r"^\d{8}_\d{6}_\d{6}$")
+
 app = Flask(__name__)
 manager = CameraManager()
+# Long-lived workers for triple_snap: one per camera plus one for the phone upload
+CAP_POOL = ThreadPoolExecutor(max_workers=len(manager.list_cameras()) + 1, thread_name_prefix="cap")
 
 
 @app.route("/")
@@ -32,29 +50,32 @@ def api_cameras():
     return jsonify({"cameras": manager.list_cameras()})
 
 
+# Multipart part header; the CRLF that ends the previous part leads the
+# boundary so each frame needs just this small header plus the JPEG itself.
+_MJPEG_PART_HEADER = b"\r\n--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n"
+
+
 def mjpeg_generator(cam_id: str) -> Generator[bytes, None, None]:
-    boundary = b"--frame"
     ctrl = manager.get(cam_id)
     output = ctrl.output
+    last_seq = output.seq
     while True:
-        with output.condition:
-            output.condition.wait()
-            frame = output.frame
+        # Skip straight to the newest frame if we fell behind
+        frame, seq = output.wait_frame(last_seq)
+        if seq == last_seq:
+            continue
+        last_seq = seq
         if frame is None:
             continue
-        yield (
-            boundary
-            + b"\r\nContent-Type: image/jpeg\r\nContent-Length: "
-            + str(len(frame)).encode()
-            + b"\r\n\r\n"
-            + frame
-            + b"\r\n"
-        )
+        # Two chunks rather than header + frame joined into a new bytes
+        # object; the server copies each into its output buffer regardless.
+        yield _MJPEG_PART_HEADER % len(frame)
+        yield frame
 
 
 @app.route("/stream/<cam_id>.mjpg")
 def stream(cam_id: str):
-    if cam_id not in {c["id"] for c in manager.list_cameras()}:
+    if not manager.has(cam_id):
         return "Camera not found", 404
     headers = {"Age": "0", "Cache-Control": "no-cache, private", "Pragma": "no-cache"}
     return Response(
@@ -67,7 +88,7 @@ def stream(cam_id: str):
 
 @app.route("/api/<cam_id>/capture", methods=["POST"])  # capture and save still from a single Pi cam
 def capture(cam_id: str):
-    if cam_id not in {c["id"] for c in manager.list_cameras()}:
+    if not manager.has(cam_id):
         return "Camera not found", 404
     ctrl = manager.get(cam_id)
     path = ctrl.capture_still(CAPTURES_DIR)
@@ -101,25 +122,23 @@ def triple_snap():
         ext = ".png"
     phone_name = f"phone_{ts}{ext}"
     phone_path = os.path.join(CAPTURES_DIR, phone_name)
-    phone_file.save(phone_path)
+    # Save the phone upload on the pool too; it is pure I/O and overlaps the captures
+    # Copy in 1 MiB chunks rather than FileStorage's default 16 KiB
+    phone_future = CAP_POOL.submit(phone_file.save, phone_path, buffer_size=1 << 20)
 
-    # Capture both Pi cameras concurrently for minimal skew
+    # Capture both Pi cameras concurrently for minimal skew; workers are
+    # already parked, so no per-request thread start-up
     cam_ids = [c["id"] for c in manager.list_cameras()]
     results: list[dict] = []
-    threads: list[threading.Thread] = []
+    futures = {cid: CAP_POOL.submit(manager.get(cid).capture_still, CAPTURES_DIR) for cid in cam_ids}
     captured: dict[str, str] = {}
-
-    def do_cap(cid: str):
-        ctrl = manager.get(cid)
-        path = ctrl.capture_still(CAPTURES_DIR)
-        captured[cid] = path
-
-    for cid in cam_ids:
-        t = threading.Thread(target=do_cap, args=(cid,), daemon=True)
-        threads.append(t)
-        t.start()
-    for t in threads:
-        t.join()
+    for cid, fut in futures.items():
+        try:
+            captured[cid] = fut.result()
+        except Exception:
+            # A failed camera is left out of the results
+            app.logger.exception("Capture failed for camera %s", cid)
+    phone_future.result()
 
     for cid, path in captured.items():
         results.append({
@@ -137,36 +156,104 @@ def triple_snap():
     })
 
 
-@app.route("/api/history")
-def history():
+def _history_entry(fn: str):
+    m = _HIST_RE.search(fn)
+    if not m:
+        # Skip non-conforming names
+        return None
+    ts = m.group(1)
+    kind = 'phone' if fn.startswith('phone_') else 'pi'
+    label = None
+    if kind == 'pi':
+        label = fn.rsplit('_' + ts, 1)[0]
+    return ts, {
+        'name': fn,
+        'url': f'/captures/{fn}',
+        'type': kind,
+        'label': label,
+    }
+
+
+# In-memory history (timestamp -> {name: entry}), maintained by the inotify
+# watcher below. Only used while _HISTORY_LIVE is set; otherwise /api/history
+# lists the directory itself.
+_HISTORY: dict[str, dict[str, dict]] = {}
+_HISTORY_LOCK = threading.Lock()
+_HISTORY_LIVE = False
+
+
+def _history_add(fn: str):
+    parsed = _history_entry(fn)
+    if parsed is None:
+        return
+    ts, entry = parsed
+    with _HISTORY_LOCK:
+        _HISTORY.setdefault(ts, {})[fn] = entry
+
+
+def _history_remove(fn: str):
+    m = _HIST_RE.search(fn)
+    if not m:
+        return
+    with _HISTORY_LOCK:
+        group = _HISTORY.get(m.group(1))
+        if group is not None:
+            group.pop(fn, None)
+            if not group:
+                del _HISTORY[m.group(1)]
+
+
+def _history_watch():  # pragma: no cover
+    global _HISTORY_LIVE
+    try:
+        os.makedirs(CAPTURES_DIR, exist_ok=True)
+        inotify = INotify()
+        removed = inotify_flags.DELETE | inotify_flags.MOVED_FROM
+        inotify.add_watch(CAPTURES_DIR, inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO | removed)
+        # Seed after the watch is in place so nothing written meanwhile is missed
+        with os.scandir(CAPTURES_DIR) as it:
+            for entry in it:
+                _history_add(entry.name)
+        _HISTORY_LIVE = True
+        while True:
+            for event in inotify.read():
+                if event.mask & inotify_flags.IGNORED:
+                    raise RuntimeError("captures directory watch was removed")
+                if event.mask & removed:
+                    _history_remove(event.name)
+                else:
+                    _history_add(event.name)
+    except Exception:
+        app.logger.exception("History watcher stopped; falling back to directory scans")
+    finally:
+        _HISTORY_LIVE = False
+
+
+if INotify is not None:
+    threading.Thread(target=_history_watch, name="history-watch", daemon=True).start()
+
+
+def _scan_history() -> dict[str, list[dict]]:
     os.makedirs(CAPTURES_DIR, exist_ok=True)
-    files = []
+    groups: dict[str, list[dict]] = {}
     try:
-        for name in os.listdir(CAPTURES_DIR):
-            if not (name.lower().endswith('.jpg') or name.lower().endswith('.png')):
-                continue
-            files.append(name)
+        with os.scandir(CAPTURES_DIR) as it:
+            for entry in it:
+                parsed = _history_entry(entry.name)
+                if parsed is not None:
+                    groups.setdefault(parsed[0], []).append(parsed[1])
     except FileNotFoundError:
         pass
-    # Group by timestamp pattern _YYYYmmdd_HHMMSS_mmmuuu
-    pat = re.compile(r"_(\d{8}_\d{6}_\d{6})\.(jpg|png)$", re.IGNORECASE)
-    groups: dict[str, list[dict]] = {}
-    for fn in files:
-        m = pat.search(fn)
-        if not m:
-            # Skip non-conforming names
-            continue
-        ts = m.group(1)
-        kind = 'phone' if fn.startswith('phone_') else 'pi'
-        label = None
-        if kind == 'pi':
-            label = fn.rsplit('_' + ts, 1)[0]
-        groups.setdefault(ts, []).append({
-            'name': fn,
-            'url': f'/captures/{fn}',
-            'type': kind,
-            'label': label,
-        })
+    return groups
+
+
+@app.route("/api/history")
+def history():
+    if _HISTORY_LIVE:
+        with _HISTORY_LOCK:
+            groups = {ts: list(entries.values()) for ts, entries in _HISTORY.items()}
+    else:
+        groups = _scan_history()
     # Sort groups by timestamp desc
     out = []
     for ts in sorted(groups.keys(), reverse=True):
@@ -184,7 +271,11 @@ def _zip_files_response(filepaths: list[str], zip_basename: str):
             if not os.path.isfile(fp):
                 continue
             arcname = os.path.basename(fp)
-            zf.write(fp, arcname)
+            # JPEG/PNG are already compressed; deflating them burns CPU for ~0% gain
+            if arcname.lower().endswith(_COMPRESSED_EXT):
+                zf.write(fp, arcname, compress_type=zipfile.ZIP_STORED)
+            else:
+                zf.write(fp, arcname)
 
     @after_this_request
     def _cleanup(response):  # pragma: no cover
@@ -194,15 +285,17 @@ def _zip_files_response(filepaths: list[str], zip_basename: str):
             pass
         return response
 
+    # A path (not a file object) lets the server use wsgi.file_wrapper/sendfile;
+    # one-shot downloads don't need Range/ETag handling
     return send_file(tmp_path, mimetype='application/zip', as_attachment=True,
-                     download_name=f'{zip_basename}.zip')
+                     download_name=f'{zip_basename}.zip', conditional=False, etag=False)
 
 
 @app.route('/api/zip_all')
 def zip_all():
     os.makedirs(CAPTURES_DIR, exist_ok=True)
-    fpaths = [os.path.join(CAPTURES_DIR, f) for f in os.listdir(CAPTURES_DIR)
-              if f.lower().endswith(('.jpg', '.png'))]
+    with os.scandir(CAPTURES_DIR) as it:
+        fpaths = [entry.path for entry in it if entry.name.lower().endswith(_IMG_EXT)]
     base = 'captures_all_' + datetime.now().strftime('%Y%m%d_%H%M%S')
     return _zip_files_response(fpaths, base)
 
@@ -210,13 +303,12 @@ def zip_all():
 @app.route('/api/zip_set/<ts>')
 def zip_set(ts: str):
     # Basic validation of ts format
-    if not re.match(r"^\d{8}_\d{6}_\d{6}$", ts):
+    if not _TS_RE.match(ts):
         return 'Bad timestamp', 400
     os.makedirs(CAPTURES_DIR, exist_ok=True)
-    fpaths = []
-    for f in os.listdir(CAPTURES_DIR):
-        if f.endswith(f'_{ts}.jpg') or f.endswith(f'_{ts}.png'):
-            fpaths.append(os.path.join(CAPTURES_DIR, f))
+    suffixes = (f'_{ts}.jpg', f'_{ts}.png')
+    with os.scandir(CAPTURES_DIR) as it:
+        fpaths = [entry.path for entry in it if entry.name.endswith(suffixes)]
     if not fpaths:
         return 'Not found', 404
     base = f'captures_{ts}'
@@ -240,7 +332,23 @@ def run():  # pragma: no cover
     key = os.environ.get("SSL_KEY")
     if cert and key and os.path.exists(cert) and os.path.exists(key):
         ssl_ctx = (cert, key)
-    app.run(host="0.0.0.0", port=APP_PORT, threaded=True, ssl_context=ssl_ctx)
+    try:
+        from waitress import serve
+    except ImportError:
+        serve = None
+    if ssl_ctx is not None or serve is None:
+        # waitress has no TLS; with a cert configured (or no waitress) use
+        # Flask's dev server. Terminate TLS at a proxy to get waitress too.
+        app.run(host="0.0.0.0", port=APP_PORT, threaded=True, ssl_context=ssl_ctx)
+        return
+    # Bounded worker pool; each open MJPEG stream holds one thread
+    # Small per-connection output buffers: once a slow viewer has ~256 KiB
+    # queued the stream thread blocks (and then skips to the newest frame)
+    # instead of waitress buffering seconds of stale frames or spilling
+    # them to a tempfile on the SD card
+    serve(app, host="0.0.0.0", port=APP_PORT, threads=APP_THREADS,
+          connection_limit=200, cleanup_interval=30,
+          outbuf_high_watermark=256 * 1024, outbuf_overflow=512 * 1024)
 
 
 if __name__ == "__main__":  # pragma: no cover
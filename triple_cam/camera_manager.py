@@ -5,7 +5,7 @@ import tempfile
 from datetime import datetime
 
 from picamera2 import Picamera2
-from picamera2.encoders import MJPEGEncoder
+from picamera2.encoders import JpegEncoder, MJPEGEncoder
 from picamera2.outputs import FileOutput
 
 try:
@@ -14,22 +14,64 @@ try:
 except Exception:  # pragma: no cover
     controls = None  # Fallback to raw values if enums unavailable
 
+# Friendly name -> enum lookups, built once rather than per control request
+if controls is not None:
+    _AF_MODE_MAP = {
+        "manual": controls.AfModeEnum.Manual,
+        "auto": controls.AfModeEnum.Auto,
+        "continuous": controls.AfModeEnum.Continuous,
+    }
+    _AF_TRIGGER_MAP = {
+        "start": controls.AfTriggerEnum.Start,
+        "cancel": controls.AfTriggerEnum.Cancel,
+    }
+else:  # pragma: no cover
+    _AF_MODE_MAP = {}
+    _AF_TRIGGER_MAP = {}
+
 
 class StreamingOutput(io.BufferedIOBase):
     def __init__(self):
-        self.frame = None  # type: bytes | None
-        self.condition = threading.Condition()
+        # Latest (frame, seq) pair; replaced with a single attribute assignment
+        # so readers always see a matching frame and sequence number.
+        self.latest = (None, 0)  # type: tuple[bytes | None, int]
+        # Set once when the next frame lands, then replaced by a fresh event
+        self.event = threading.Event()
+
+    @property
+    def frame(self) -> bytes | None:
+        return self.latest[0]
+
+    @property
+    def seq(self) -> int:
+        return self.latest[1]
 
     def writable(self) -> bool:  # type: ignore[override]
         return True
 
     def write(self, buf: bytes) -> int:  # type: ignore[override]
-        # For MJPEGEncoder, each call to write is a complete JPEG frame
-        with self.condition:
-            self.frame = bytes(buf)
-            self.condition.notify_all()
+        # For MJPEGEncoder, each call to write is a complete JPEG frame.
+        # FileOutput already hands us immutable bytes; only copy views.
+        frame = buf if isinstance(buf, bytes) else bytes(buf)
+        self.latest = (frame, self.latest[1] + 1)
+        # Swap in a fresh event before waking readers so late arrivals
+        # block until the frame after this one.
+        event, self.event = self.event, threading.Event()
+        event.set()
         return len(buf)
 
+    def wait_frame(self, last_seq: int, timeout: float | None = None) -> tuple[bytes | None, int]:
+        """Block until a frame newer than ``last_seq`` is published.
+
+        Returns the latest ``(frame, seq)``; ``seq == last_seq`` on timeout.
+        """
+        event = self.event
+        latest = self.latest
+        if latest[1] != last_seq:
+            return latest
+        event.wait(timeout)
+        return self.latest
+
 
 class CameraController:
     def __init__(self, index: int, label: str | None = None,
@@ -56,7 +98,20 @@ class CameraController:
         # Start camera and MJPEG recording
         self.picam2.start()
         # Send encoded frames to our in-memory output
-        self.picam2.start_recording(self.encoder, FileOutput(self.output))
+        self._start_recording()
+
+    def _start_recording(self):
+        # The hardware MJPEGEncoder only opens its V4L2 device when recording
+        # starts, so that is where a missing device shows up; retry once with
+        # the software JpegEncoder. (Recent Picamera2 already substitutes a
+        # libav encoder for MJPEGEncoder on hardware without the V4L2 block.)
+        try:
+            self.picam2.start_recording(self.encoder, FileOutput(self.output))
+        except Exception:
+            if isinstance(self.encoder, JpegEncoder):
+                raise
+            self.encoder = JpegEncoder()
+            self.picam2.start_recording(self.encoder, FileOutput(self.output))
 
     def get_metadata(self) -> dict:
         try:
@@ -101,29 +156,10 @@ class CameraController:
             self.picam2.set_controls(m)
 
     def _af_mode_value(self, v):
-        if controls is None:
-            return v
-        if isinstance(v, str):
-            name = v.strip().lower()
-            mapping = {
-                "manual": controls.AfModeEnum.Manual,
-                "auto": controls.AfModeEnum.Auto,
-                "continuous": controls.AfModeEnum.Continuous,
-            }
-            return mapping.get(name, v)
-        return v
+        return _AF_MODE_MAP.get(v.strip().lower(), v) if isinstance(v, str) else v
 
     def _af_trigger_value(self, v):
-        if controls is None:
-            return v
-        if isinstance(v, str):
-            name = v.strip().lower()
-            mapping = {
-                "start": controls.AfTriggerEnum.Start,
-                "cancel": controls.AfTriggerEnum.Cancel,
-            }
-            return mapping.get(name, v)
-        return v
+        return _AF_TRIGGER_MAP.get(v.strip().lower(), v) if isinstance(v, str) else v
 
     def capture_still(self, dir_path: str) -> str:
         os.makedirs(dir_path, exist_ok=True)
@@ -139,7 +175,7 @@ class CameraController:
             self.picam2.capture_file(path)
             self.picam2.switch_mode(self.preview_config)
             try:
-                self.picam2.start_recording(self.encoder, FileOutput(self.output))
+                self._start_recording()
             except Exception:
                 pass
         return path
@@ -165,7 +201,7 @@ class CameraController:
             finally:
                 self.picam2.switch_mode(self.preview_config)
                 try:
-                    self.picam2.start_recording(self.encoder, FileOutput(self.output))
+                    self._start_recording()
                 except Exception:
                     pass
             return data or b''
@@ -190,16 +226,18 @@ class CameraManager:
             label = cam.get("Model") or cam.get("Id") or f"cam{idx}"
             controller = CameraController(index=idx, label=label)
             self.controllers[str(idx)] = controller
+        # Cameras are enumerated once; cache their ids and listing for requests
+        self._ids = frozenset(self.controllers)
+        self._cams_cached = [
+            {"id": cam_id, "label": ctrl.label, "index": ctrl.index}
+            for cam_id, ctrl in self.controllers.items()
+        ]
+
+    def has(self, cam_id: str) -> bool:
+        return cam_id in self._ids
 
     def list_cameras(self):
-        cams = []
-        for cam_id, ctrl in self.controllers.items():
-            cams.append({
-                "id": cam_id,
-                "label": ctrl.label,
-                "index": ctrl.index,
-            })
-        return cams
+        return self._cams_cached
 
     def get(self, cam_id: str) -> CameraController:
         return self.controllers[cam_id]